@@ -1,16 +1,33 @@
 import os
+import re
+import asyncio
+import functools
+import importlib.util
 import sys
 import subprocess
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
 from NLP.LLM import LLMInterface, AgentManager
 
 # 尝试加载环境变量文件
-try:
+if importlib.util.find_spec("dotenv") is not None:
     from dotenv import load_dotenv
     load_dotenv()
-except ImportError:
+else:
     print("警告: python-dotenv 未安装，将使用系统环境变量")
 
+# 只探测ASR/TTS依赖是否已安装，不导入模块，模型在首次使用时才加载
+_HAS_ASR = importlib.util.find_spec("qwen_asr") is not None
+_HAS_TTS = importlib.util.find_spec("qwen_tts") is not None
+
+# 音频写出依赖，缺失时仅影响语音合成
+try:
+    import numpy as np
+    import soundfile as sf
+except ImportError:
+    np = None
+    sf = None
+
 
 
 def is_in_venv():
@@ -32,38 +49,243 @@ def venv_exists(venv_name="venv"):
     venv_python = get_venv_python(venv_name)
     return os.path.exists(venv_python)
 
+# 批量识别时每批音频的总帧数上限
+MAX_FRAMES_PER_BATCH = int(os.getenv("ASR_MAX_FRAMES_PER_BATCH", str(16000 * 240)))
+
+# TTS 输出采样率
+TTS_SAMPLE_RATE = int(os.getenv("TTS_SAMPLE_RATE", "24000"))
+
+# TTS 分词结果缓存条目数；缓存的是 CPU 上的整数元组，每条约为 token 数 × 8 字节
+TTS_TOKEN_CACHE_SIZE = 1024
+
+# 流式输出中的句子结束符，TTS 按句合成；英文句点后须跟空白，避免拆开 "3.5"、"e.g."
+_SENTENCE_END = re.compile(r"[。！？!?\n]|\.(?=\s)")
+
+
+def _split_sentences(buffer: str):
+    """切出缓冲区中已完整的句子，返回 (句子列表, 剩余文本)"""
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END.finditer(buffer):
+        sentence = buffer[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    return sentences, buffer[start:]
+
+
+def iter_sentences(chunks: Iterable[str]) -> Iterator[str]:
+    """将流式文本块按句子边界重新切分"""
+    buffer = ""
+    for chunk in chunks:
+        sentences, buffer = _split_sentences(buffer + chunk)
+        yield from sentences
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def aiter_sentences(chunks: AsyncIterable[str]) -> AsyncIterator[str]:
+    """iter_sentences 的异步版本"""
+    buffer = ""
+    async for chunk in chunks:
+        sentences, buffer = _split_sentences(buffer + chunk)
+        for sentence in sentences:
+            yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def _freeze_tokens(tokens):
+    """将分词结果转换为不可变的 CPU 形式以便缓存，张量转为嵌套元组"""
+    if hasattr(tokens, "detach"):
+        values = tokens.detach().cpu().tolist()
+        return ("tensor", _to_tuple(values), tokens.dtype, tokens.device)
+    if hasattr(tokens, "tolist") and hasattr(tokens, "dtype"):
+        return ("array", _to_tuple(tokens.tolist()), tokens.dtype)
+    if isinstance(tokens, Mapping):
+        return ("mapping", type(tokens), tuple((key, _freeze_tokens(value)) for key, value in tokens.items()))
+    if isinstance(tokens, (list, tuple)):
+        return ("sequence", type(tokens), tuple(_freeze_tokens(item) for item in tokens))
+    return ("value", tokens)
+
+
+def _to_tuple(values):
+    """将嵌套列表转换为嵌套元组"""
+    if isinstance(values, list):
+        return tuple(_to_tuple(item) for item in values)
+    return values
+
+
+def _thaw_tokens(frozen):
+    """由缓存的不可变形式重建分词结果，每次调用都返回新对象，模型原地修改不会污染缓存"""
+    kind = frozen[0]
+    if kind == "tensor":
+        import torch
+        _, values, dtype, device = frozen
+        return torch.as_tensor(values, dtype=dtype, device=device)
+    if kind == "array":
+        return np.asarray(frozen[1], dtype=frozen[2])
+    if kind == "mapping":
+        _, mapping_type, items = frozen
+        return mapping_type({key: _thaw_tokens(value) for key, value in items})
+    if kind == "sequence":
+        _, sequence_type, items = frozen
+        return sequence_type(_thaw_tokens(item) for item in items)
+    return frozen[1]
+
+
+def to_pcm16(audio):
+    """将 [-1, 1] 浮点波形转换为一维 int16 PCM"""
+    if hasattr(audio, "detach"):
+        # torch 张量：先转 float32，半精度下 1.0 * 32767 会舍入为 32768 并在转 int16 时溢出
+        import torch
+        return audio.detach().reshape(-1).float().clamp(-1, 1).mul_(32767).to(torch.int16).cpu().numpy()
+    pcm = np.clip(np.asarray(audio, dtype=np.float32).reshape(-1), -1.0, 1.0)
+    pcm *= 32767
+    return pcm.astype(np.int16, copy=False)
+
+
+def _torch_module(model):
+    """返回模型对应的 torch.nn.Module；推理封装类通常把它放在 .model 属性中"""
+    import torch
+    if isinstance(model, torch.nn.Module):
+        return model
+    inner = getattr(model, "model", None)
+    return inner if isinstance(inner, torch.nn.Module) else None
+
+
+def quantize_model(model, mode: Optional[str]):
+    """量化模型的 Linear 层：int8 使用 CPU 动态量化，fp8 使用 torchao（需 Ada/Hopper GPU）"""
+    if not mode:
+        return model
+    
+    try:
+        import torch
+        module = _torch_module(model)
+        if module is None:
+            print(f"警告: {type(model).__name__} 不包含 torch.nn.Module，保持原精度")
+            return model
+        
+        if mode == "int8":
+            param = next(module.parameters(), None)
+            if param is not None and param.device.type != "cpu":
+                print("警告: int8 动态量化仅支持 CPU 模型，保持原精度")
+                return model
+            quantized = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+            if module is model:
+                return quantized
+            model.model = quantized
+            return model
+        
+        if mode == "fp8":
+            if not torch.cuda.is_available() or torch.cuda.get_device_capability() < (8, 9):
+                print("警告: 当前 GPU 不支持 FP8，保持原精度")
+                return model
+            from torchao.quantization import quantize_, float8_dynamic_activation_float8_weight
+            quantize_(module, float8_dynamic_activation_float8_weight())
+            return model
+        
+        print(f"警告: 未知的量化模式 {mode}，保持原精度")
+    except Exception as e:
+        print(f"警告: 模型量化失败，保持原精度: {str(e)}")
+    return model
+
+
+def compile_model(model):
+    """使用 torch.compile 编译模型前向，融合算子（需设置 TORCH_COMPILE_ENABLED）"""
+    if os.getenv("TORCH_COMPILE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return model
+    
+    try:
+        module = _torch_module(model)
+        if module is None:
+            print(f"警告: {type(model).__name__} 不包含 torch.nn.Module，跳过 torch.compile")
+            return model
+        # 输入长度不做分桶，reduce-overhead 会为每个新长度重新录制 CUDA graph，因此默认不启用
+        # 原地编译，封装类内部通过 self(...) 调用（如 generate）时也会走编译后的前向
+        module.compile(mode=os.getenv("TORCH_COMPILE_MODE", "default"))
+        return model
+    except Exception as e:
+        print(f"警告: torch.compile 失败，使用 eager 模式: {str(e)}")
+        return model
+
+
 class ANT:
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
-        """初始化ANT智能体系统"""
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, quantize: Optional[str] = None, draft_model: Optional[str] = None):
+        """初始化ANT智能体系统，quantize 可选 "int8" 或 "fp8"，默认保持原精度；draft_model 为自托管推理引擎的投机解码草稿模型"""
         # 初始化NLP模块
-        self.llm = LLMInterface(api_key=api_key, base_url=base_url)
+        self.llm = LLMInterface(api_key=api_key, base_url=base_url, draft_model=draft_model)
         self.agent_manager = AgentManager(self.llm)
         
-        # 初始化ASR和TTS模块（预留接口）
-        self.asr_available = False
-        self.tts_available = False
+        self.quantize = quantize or os.getenv("MODEL_QUANTIZE") or None
+        
+        # ASR和TTS模块在首次使用时才加载
+        self._asr = None
+        self._tts_tokenizer = None
+        self._tts_model = None
+        self._tokenize = None
+        self.asr_available = _HAS_ASR
+        self.tts_available = _HAS_TTS
+    
+    def _ensure_asr(self) -> bool:
+        """首次使用时导入并初始化ASR模块"""
+        if self._asr is not None:
+            return True
+        if not self.asr_available:
+            return False
         
-        # 尝试导入ASR模块
         try:
             from qwen_asr.inference.qwen3_asr import Qwen3ASR
-            self.asr = Qwen3ASR()
-            self.asr_available = True
+            self._asr = compile_model(quantize_model(Qwen3ASR(), self.quantize))
         except ImportError:
             print("ASR module not available. Please install ASR dependencies.")
+            self.asr_available = False
         except Exception as e:
             print(f"Error initializing ASR: {str(e)}")
+            self.asr_available = False
+        return self._asr is not None
+    
+    def _ensure_tts(self) -> bool:
+        """首次使用时导入并初始化TTS模块"""
+        if self._tts_model is not None:
+            return True
+        if not self.tts_available:
+            return False
         
-        # 尝试导入TTS模块
         try:
             from qwen_tts.inference.qwen3_tts_model import Qwen3TTSModel
             from qwen_tts.inference.qwen3_tts_tokenizer import Qwen3TTSTokenizer
-            self.tts_tokenizer = Qwen3TTSTokenizer()
-            self.tts_model = Qwen3TTSModel()
-            self.tts_available = True
+            self._tts_tokenizer = Qwen3TTSTokenizer()
+            # 问候语等短文本反复出现，缓存分词结果避免重复编码
+            self._tokenize = functools.lru_cache(maxsize=TTS_TOKEN_CACHE_SIZE)(
+                lambda text: _freeze_tokens(self._tts_tokenizer(text))
+            )
+            self._tts_model = compile_model(quantize_model(Qwen3TTSModel(), self.quantize))
         except ImportError:
             print("TTS module not available. Please install TTS dependencies.")
+            self.tts_available = False
         except Exception as e:
             print(f"Error initializing TTS: {str(e)}")
+            self.tts_available = False
+        return self._tts_model is not None
+    
+    @property
+    def asr(self):
+        """ASR模型（延迟加载）"""
+        self._ensure_asr()
+        return self._asr
+    
+    @property
+    def tts_tokenizer(self):
+        """TTS分词器（延迟加载）"""
+        self._ensure_tts()
+        return self._tts_tokenizer
+    
+    @property
+    def tts_model(self):
+        """TTS模型（延迟加载）"""
+        self._ensure_tts()
+        return self._tts_model
     
     def set_agent(self, agent_name: str):
         """设置智能体角色"""
@@ -79,45 +301,231 @@ class ANT:
     
     def process_audio(self, audio_path: str) -> Optional[str]:
         """处理音频输入"""
-        if not self.asr_available:
+        if not self._ensure_asr():
             return "ASR module not available"
         
         try:
             # 使用ASR识别音频
             text = self.asr(audio_path)
             
-            # 处理识别的文本
-            response = self.process_text(text)
+            if not self._ensure_tts():
+                return self.process_text(text)
+            
+            # 流式处理识别的文本，每收到完整的一句就开始合成语音
+            # 保留原始文本块，返回值与模型输出一致（分句会去掉句间空白）
+            parts = []
+            stream = self.llm.iter_response(text)
+            
+            def record_parts():
+                for chunk in stream:
+                    parts.append(chunk)
+                    yield chunk
+            
+            def synthesize_sentences():
+                for sentence in iter_sentences(record_parts()):
+                    yield self._synthesize(sentence)
+            
+            try:
+                self._write_audio(synthesize_sentences(), "output.wav")
+            except Exception as e:
+                print(f"Error synthesizing speech: {str(e)}")
+            
+            # TTS 失败时继续读完回复，保证助手消息写入对话历史
+            for chunk in stream:
+                parts.append(chunk)
+            return "".join(parts)
+        except Exception as e:
+            return f"Error processing audio: {str(e)}"
+    
+    async def aprocess_audio(self, audio_path: str, output_path: str = "output.wav") -> Optional[str]:
+        """异步处理音频输入，LLM 流式生成的同时逐句合成语音"""
+        loop = asyncio.get_running_loop()
+        # 模型加载耗时数秒，放到线程中避免阻塞事件循环
+        if not await loop.run_in_executor(None, self._ensure_asr):
+            return "ASR module not available"
+        
+        try:
+            # ASR 在线程中运行，避免阻塞事件循环
+            text = await loop.run_in_executor(None, self.asr, audio_path)
+            
+            if not await loop.run_in_executor(None, self._ensure_tts):
+                return await self.llm.agenerate_response(text)
+            
+            # 保留原始文本块，返回值与模型输出一致（分句会去掉句间空白）
+            parts = []
+            stream = self.llm.aiter_response(text)
+            
+            async def record_parts():
+                async for chunk in stream:
+                    parts.append(chunk)
+                    yield chunk
             
-            # 使用TTS合成语音（如果可用）
-            if self.tts_available:
-                self.synthesize_speech(response, "output.wav")
+            try:
+                await self._astream_speech(record_parts(), output_path)
+            except Exception as e:
+                print(f"Error synthesizing speech: {str(e)}")
             
-            return response
+            # TTS 失败时继续读完回复，保证助手消息写入对话历史
+            async for chunk in stream:
+                parts.append(chunk)
+            return "".join(parts)
         except Exception as e:
             return f"Error processing audio: {str(e)}"
     
+    async def _astream_speech(self, chunks: AsyncIterable[str], output_path: str):
+        """逐句合成流式文本并按顺序写入音频文件，合成与 LLM 解码重叠"""
+        if sf is None:
+            raise RuntimeError("soundfile 未安装，无法保存音频")
+        
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        # TTS 使用单线程执行器，按句子顺序合成
+        with ThreadPoolExecutor(max_workers=1) as tts_executor, \
+                sf.SoundFile(output_path, mode="w", samplerate=TTS_SAMPLE_RATE, channels=1, subtype="PCM_16") as wav_writer:
+            async def write_segments():
+                while True:
+                    task = await queue.get()
+                    if task is None:
+                        return
+                    wav_writer.write(to_pcm16(await task))
+            
+            writer = asyncio.create_task(write_segments())
+            try:
+                async for sentence in aiter_sentences(chunks):
+                    # 写入任务已失败时不再提交新的合成
+                    if writer.done():
+                        break
+                    await queue.put(loop.run_in_executor(tts_executor, self._synthesize, sentence))
+            finally:
+                await queue.put(None)
+                try:
+                    await writer
+                finally:
+                    # 写入失败时取消尚未处理的合成任务，已完成的任务取走结果避免未检索异常的警告
+                    while not queue.empty():
+                        task = queue.get_nowait()
+                        if task is None:
+                            continue
+                        if task.done():
+                            if not task.cancelled():
+                                task.exception()
+                        else:
+                            task.cancel()
+        
+        print(f"Speech synthesized to {output_path}")
+    
+    def _bucket_by_length(self, paths: List[str]) -> Tuple[List[List[str]], List[str]]:
+        """按音频帧数排序并装箱，每批总帧数不超过 MAX_FRAMES_PER_BATCH；返回 (批次列表, 无法读取时长的文件)"""
+        frames: Dict[str, int] = {}
+        unreadable: List[str] = []
+        for path in paths:
+            try:
+                frames[path] = sf.info(path).frames
+            except Exception:
+                # libsndfile 不支持的格式（如 mp3/m4a）或文件缺失，交给 ASR 单独处理
+                unreadable.append(path)
+        
+        batches: List[List[str]] = []
+        current: List[str] = []
+        total = 0
+        for path in sorted(frames, key=frames.get):
+            if current and total + frames[path] > MAX_FRAMES_PER_BATCH:
+                batches.append(current)
+                current, total = [], 0
+            current.append(path)
+            total += frames[path]
+        if current:
+            batches.append(current)
+        return batches, unreadable
+    
+    def _transcribe_all(self, paths: List[str]) -> Dict[str, str]:
+        """识别一组音频；ASR 支持批量接口时按长度分批，否则逐个识别"""
+        single = paths
+        transcripts: Dict[str, str] = {}
+        if hasattr(self.asr, "batch_transcribe") and sf is not None:
+            # 长度相近的音频分到同一批，减少填充开销
+            batches, single = self._bucket_by_length(paths)
+            for batch in batches:
+                transcripts.update(zip(batch, self.asr.batch_transcribe(batch)))
+        for path in single:
+            transcripts[path] = self.asr(path)
+        return transcripts
+    
+    def process_audio_batch(self, paths: List[str], output_dir: str = ".") -> Dict[str, str]:
+        """批量处理音频输入，返回 {音频路径: 响应}，语音输出写入 output_dir/<文件名>_reply_<序号>.wav"""
+        if not self._ensure_asr():
+            return {path: "ASR module not available" for path in paths}
+        
+        results: Dict[str, str] = {}
+        try:
+            transcripts = self._transcribe_all(paths)
+            
+            # 对话历史有先后依赖，按输入顺序逐条生成响应
+            for path in paths:
+                results[path] = self.process_text(transcripts[path])
+            
+            if not self._ensure_tts():
+                return results
+            
+            # 合成在主线程进行，写文件交给线程池与下一条合成重叠
+            input_paths = {os.path.realpath(path) for path in paths}
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = {}
+                for index, path in enumerate(paths):
+                    # 文件名带序号，不同目录下的同名输入不会互相覆盖
+                    name = f"{os.path.splitext(os.path.basename(path))[0]}_reply_{index}.wav"
+                    output_path = os.path.join(output_dir, name)
+                    if os.path.realpath(output_path) in input_paths:
+                        results[path] = f"Error processing audio: 输出路径与输入文件相同: {output_path}"
+                        continue
+                    try:
+                        audio = self._synthesize(results[path])
+                        futures[path] = executor.submit(self._write_audio, [audio], output_path)
+                    except Exception as e:
+                        results[path] = f"Error processing audio: {str(e)}"
+                for path, future in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        results[path] = f"Error processing audio: {str(e)}"
+        except Exception as e:
+            for path in paths:
+                results.setdefault(path, f"Error processing audio: {str(e)}")
+        return results
+    
+    def _synthesize(self, text: str):
+        """合成一段文本，返回音频波形"""
+        self._ensure_tts()
+        return self._tts_model(_thaw_tokens(self._tokenize(text)))
+    
+    def _write_audio(self, segments: Iterable, output_path: str):
+        """将音频片段依次以 16 位 PCM 写入文件"""
+        if sf is None:
+            raise RuntimeError("soundfile 未安装，无法保存音频")
+        with sf.SoundFile(output_path, mode="w", samplerate=TTS_SAMPLE_RATE, channels=1, subtype="PCM_16") as f:
+            for segment in segments:
+                f.write(to_pcm16(segment))
+        print(f"Speech synthesized to {output_path}")
+    
     def synthesize_speech(self, text: str, output_path: str):
         """合成语音"""
-        if not self.tts_available:
+        if not self._ensure_tts():
             print("TTS module not available")
             return
         
         try:
-            # 使用TTS合成语音
-            tokens = self.tts_tokenizer(text)
-            audio = self.tts_model(tokens)
-            
-            # 保存音频到文件
-            import soundfile as sf
-            sf.write(output_path, audio, 24000)
-            print(f"Speech synthesized to {output_path}")
+            # 使用TTS合成语音并保存到文件
+            self._write_audio([self._synthesize(text)], output_path)
         except Exception as e:
             print(f"Error synthesizing speech: {str(e)}")
     
     def chat(self, message: str) -> str:
         """聊天功能"""
-        return self.llm.generate_response(message)
+        return "".join(self.stream_chat(message))
+    
+    def stream_chat(self, message: str) -> Iterator[str]:
+        """流式聊天，逐块返回响应文本"""
+        return self.llm.iter_response(message)
     
     def clear_history(self):
         """清除对话历史"""
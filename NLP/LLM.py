@@ -1,71 +1,446 @@
 import os
+import json
+import hashlib
+import importlib.util
+import threading
+import httpx
 import openai
-from typing import List, Dict, Optional, Any
+from types import MappingProxyType
+from typing import List, Dict, Mapping, Optional, Any, Tuple, Iterator, AsyncIterator
+
+
+def _hash_prompt(prompt: str) -> str:
+    """计算系统提示词的哈希值"""
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# OpenAI 客户端连接池配置
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0)
+
+# tiktoken 编码器缓存，encoding_for_model 首次调用较慢
+_ENCODERS: Dict[str, Any] = {}
+
+
+def _get_encoder(model: str) -> Optional[Any]:
+    """获取模型对应的 tiktoken 编码器，未安装 tiktoken 时返回 None"""
+    if model in _ENCODERS:
+        return _ENCODERS[model]
+    
+    try:
+        import tiktoken
+    except ImportError:
+        encoder = None
+    else:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # 非 OpenAI 模型使用通用编码做近似估计
+            try:
+                encoder = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                encoder = None
+        except Exception:
+            # 编码表首次使用需要联网下载，失败时不估算 token
+            encoder = None
+    _ENCODERS[model] = encoder
+    return encoder
+
+
+def _count_tokens(messages: List[Dict[str, Any]], model: str) -> Optional[int]:
+    """估算消息列表的 token 数"""
+    encoder = _get_encoder(model)
+    if encoder is None:
+        return None
+    
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        # 每条消息另有约 4 个 token 的格式开销
+        total += len(encoder.encode(content, disallowed_special=())) + 4
+    return total
+
+
+class SemanticCache:
+    def __init__(self, threshold: float = 0.92, model_name: str = "all-MiniLM-L6-v2", index_path: Optional[str] = None):
+        """初始化语义缓存，嵌入模型和索引在首次使用时加载"""
+        self.threshold = threshold
+        self.model_name = model_name
+        self.index_path = index_path
+        self.available = True
+        self._embedder = None
+        self._index = None
+        # 与索引行一一对应的 (system_prompt_hash, response)
+        self._payloads: List[Tuple[str, str]] = []
+    
+    def _ensure_loaded(self) -> bool:
+        """加载嵌入模型和 faiss 索引"""
+        if self._index is not None:
+            return True
+        if not self.available:
+            return False
+        
+        try:
+            import faiss
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            print("警告: sentence-transformers 或 faiss 未安装，语义缓存已禁用")
+            self.available = False
+            return False
+        
+        try:
+            self._embedder = SentenceTransformer(self.model_name)
+            dim = self._embedder.get_sentence_embedding_dimension()
+            
+            if self.index_path and os.path.exists(self.index_path) and os.path.exists(self.index_path + ".json"):
+                self._index = faiss.read_index(self.index_path)
+                with open(self.index_path + ".json", "r", encoding="utf-8") as f:
+                    self._payloads = [tuple(row) for row in json.load(f)]
+                if self._index.d != dim or self._index.ntotal != len(self._payloads):
+                    # 索引与当前嵌入模型不匹配，丢弃旧缓存
+                    self._index = faiss.IndexFlatIP(dim)
+                    self._payloads = []
+            else:
+                self._index = faiss.IndexFlatIP(dim)
+        except Exception as e:
+            print(f"Error initializing semantic cache: {str(e)}")
+            self.available = False
+            return False
+        return True
+    
+    def embed(self, text: str) -> Optional[Any]:
+        """计算 L2 归一化的查询向量"""
+        if not self._ensure_loaded():
+            return None
+        return self._embedder.encode([text], normalize_embeddings=True).astype("float32")
+    
+    def lookup(self, embedding: Any, prompt_hash: str) -> Optional[str]:
+        """查找相似度不低于阈值且系统提示词一致的缓存响应"""
+        if embedding is None or self._index is None or self._index.ntotal == 0:
+            return None
+        
+        scores, ids = self._index.search(embedding, min(5, self._index.ntotal))
+        for score, idx in zip(scores[0], ids[0]):
+            if idx < 0 or score < self.threshold:
+                break
+            cached_hash, response = self._payloads[idx]
+            if cached_hash == prompt_hash:
+                return response
+        return None
+    
+    def add(self, embedding: Any, prompt_hash: str, response: str):
+        """添加缓存条目"""
+        if embedding is None or self._index is None:
+            return
+        self._index.add(embedding)
+        self._payloads.append((prompt_hash, response))
+    
+    def save(self):
+        """持久化缓存索引和响应"""
+        if not self.index_path or self._index is None:
+            return
+        
+        try:
+            import faiss
+            faiss.write_index(self._index, self.index_path)
+            with open(self.index_path + ".json", "w", encoding="utf-8") as f:
+                json.dump(self._payloads, f, ensure_ascii=False)
+        except Exception as e:
+            print(f"Error saving semantic cache: {str(e)}")
 
 class LLMInterface:
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
-        """初始化LLM接口"""
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, draft_model: Optional[str] = None):
+        """初始化LLM接口，draft_model 为自托管推理引擎的投机解码草稿模型"""
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         self.base_url = base_url or os.getenv("OPENAI_BASE_URL")
         self.model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
         self.temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
         self.max_tokens = int(os.getenv("OPENAI_MAX_TOKENS", "500"))
+        self.context_window = int(os.getenv("OPENAI_CONTEXT_WINDOW", "16385"))
+        self.draft_model = draft_model or os.getenv("OPENAI_DRAFT_MODEL") or None
+        self.num_speculative_tokens = int(os.getenv("OPENAI_NUM_SPECULATIVE_TOKENS", "5"))
+        # 当前智能体的停止序列，由 AgentManager 设置
+        self.stop: Optional[List[str]] = None
         
         if not self.api_key:
             raise ValueError("API key is required. Please set OPENAI_API_KEY environment variable.")
         
+        # 复用长连接并在可用时启用 HTTP/2，多轮对话无需重复 TCP/TLS 握手
+        # 使用 SDK 的默认 httpx 客户端以保留 follow_redirects 等默认设置；超时默认与 SDK 一致
+        http2 = importlib.util.find_spec("h2") is not None
+        timeout = httpx.Timeout(
+            float(os.getenv("OPENAI_TIMEOUT", "600")),
+            connect=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+        )
         self.client = openai.OpenAI(
             api_key=self.api_key,
-            base_url=self.base_url
+            base_url=self.base_url,
+            http_client=openai.DefaultHttpxClient(http2=http2, limits=_HTTP_LIMITS, timeout=timeout)
+        )
+        self.async_client = openai.AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=openai.DefaultAsyncHttpxClient(http2=http2, limits=_HTTP_LIMITS, timeout=timeout)
         )
         
-        self.conversation_history: List[Dict[str, str]] = []
+        # Anthropic 需要显式标记可缓存的前缀块
+        self._use_cache_control = "anthropic" in (self.base_url or "") or self.model.startswith("claude")
+        
+        # 对话历史分为固定前缀（系统提示词）和动态尾部（用户/助手消息），
+        # 前缀只在 set_system_prompt 中构建，保证每次请求的前缀字节一致以命中提示词缓存
         self.system_prompt = os.getenv("SYSTEM_PROMPT", "你是一个有帮助的助手。使用中文回答。")
+        self._system_prompt_hash = _hash_prompt(self.system_prompt)
+        self._static_prefix: List[Dict[str, Any]] = self._build_static_prefix()
+        self._dynamic_tail: List[Dict[str, str]] = []
+        
+        # 对话历史超过字符上限时，较早的一半消息被压缩进滚动摘要，限制每次请求的预填充长度
+        self.history_max_chars = int(os.getenv("HISTORY_MAX_CHARS", "6000"))
+        self.summary_model = os.getenv("OPENAI_SUMMARY_MODEL") or self.model
+        self._rolling_summary = ""
+        self._summary_lock = threading.Lock()
+        self._summary_thread: Optional[threading.Thread] = None
+        self._pending_summary: Optional[Tuple[int, int, str]] = None
+        # 每次重置对话历史时递增，用于丢弃过期的后台摘要
+        self._history_generation = 0
+        
+        # 语义缓存（可选）：相似的用户输入直接复用已有响应
+        self.semantic_cache: Optional[SemanticCache] = None
+        if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes"):
+            self.semantic_cache = SemanticCache(
+                threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+                model_name=os.getenv("SEMANTIC_CACHE_MODEL", "all-MiniLM-L6-v2"),
+                index_path=os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.index")
+            )
+    
+    def _build_static_prefix(self) -> List[Dict[str, Any]]:
+        """构建固定的系统提示词前缀"""
+        if self._use_cache_control:
+            content = [{"type": "text", "text": self.system_prompt, "cache_control": {"type": "ephemeral"}}]
+            return [{"role": "system", "content": content}]
+        return [{"role": "system", "content": self.system_prompt}]
+    
+    @property
+    def conversation_history(self) -> List[Dict[str, Any]]:
+        """完整对话历史（固定前缀 + 滚动摘要 + 动态尾部）"""
+        return self._static_prefix + self._summary_block() + self._dynamic_tail
+    
+    def _summary_block(self) -> List[Dict[str, str]]:
+        """滚动摘要消息，位于固定前缀之后，不影响前缀缓存"""
+        if not self._rolling_summary:
+            return []
+        return [{"role": "system", "content": f"Summary so far: {self._rolling_summary}"}]
     
-    def set_system_prompt(self, prompt: str):
-        """设置系统提示词"""
+    def _compact_history(self):
+        """历史过长时在后台线程中将较早的一半消息合并进滚动摘要，不阻塞本轮响应"""
+        if self.history_max_chars <= 0:
+            return
+        if sum(len(m["content"]) for m in self._dynamic_tail) <= self.history_max_chars:
+            return
+        
+        # 从中点起找到第一条用户消息作为切分点，保证保留的尾部以完整轮次开头；
+        # 请求失败时会留下没有回复的用户消息，因此不能假设消息严格成对
+        middle = max(1, len(self._dynamic_tail) // 2)
+        split = next((i for i in range(middle, len(self._dynamic_tail)) if self._dynamic_tail[i]["role"] == "user"), 0)
+        if split == 0:
+            return
+        
+        with self._summary_lock:
+            if self._summary_thread is not None and self._summary_thread.is_alive():
+                return
+            if self._pending_summary is not None:
+                return
+            self._summary_thread = threading.Thread(
+                target=self._summarize_history,
+                args=(self._history_generation, split, self._dynamic_tail[:split], self._rolling_summary),
+                daemon=True
+            )
+            self._summary_thread.start()
+    
+    def _summarize_history(self, generation: int, split: int, evicted: List[Dict[str, str]], previous_summary: str):
+        """生成增量摘要，结果在下一次请求前由 _apply_summary 应用"""
+        # 只对新移出的消息做增量摘要
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+        prompt = "将以下对话压缩为简洁的摘要，保留事实、用户偏好和未完成的任务。"
+        if previous_summary:
+            prompt += f"\n\n已有摘要：\n{previous_summary}"
+        prompt += f"\n\n新增对话：\n{transcript}"
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=self.summary_model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=self.max_tokens
+            )
+            summary = response.choices[0].message.content
+        except Exception as e:
+            # 摘要失败时保留原历史，下一轮再尝试
+            print(f"Error summarizing history: {str(e)}")
+            return
+        
+        with self._summary_lock:
+            self._pending_summary = (generation, split, summary)
+    
+    def _apply_summary(self):
+        """应用后台生成的摘要，移除已被摘要的消息"""
+        with self._summary_lock:
+            pending, self._pending_summary = self._pending_summary, None
+        if pending is None:
+            return
+        
+        generation, split, summary = pending
+        # 期间历史被清空或系统提示词已更换时丢弃结果；否则尾部只会追加，前 split 条即被摘要的消息
+        if generation != self._history_generation:
+            return
+        self._rolling_summary = summary
+        self._dynamic_tail = self._dynamic_tail[split:]
+    
+    def set_system_prompt(self, prompt: str, prompt_hash: Optional[str] = None):
+        """设置系统提示词，提示词未变化时保留对话历史和已缓存的前缀"""
+        prompt_hash = prompt_hash or _hash_prompt(prompt)
+        if prompt_hash == self._system_prompt_hash:
+            return
+        
         self.system_prompt = prompt
-        # 重置对话历史，应用新的系统提示词
-        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+        self._system_prompt_hash = prompt_hash
+        # 重建前缀并重置对话历史，应用新的系统提示词
+        self._static_prefix = self._build_static_prefix()
+        self._dynamic_tail = []
+        self._rolling_summary = ""
+        self._history_generation += 1
     
     def add_message(self, role: str, content: str):
         """添加消息到对话历史"""
-        self.conversation_history.append({"role": role, "content": content})
+        self._dynamic_tail.append({"role": role, "content": content})
     
-    def generate_response(self, user_input: str, model: Optional[str] = None, temperature: Optional[float] = None, max_tokens: Optional[int] = None) -> str:
-        """生成响应"""
-        # 确保系统提示词在对话历史的开头
-        if not self.conversation_history or self.conversation_history[0]["role"] != "system":
-            self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+    def _prepare_request(self, user_input: str, model: Optional[str], temperature: Optional[float], max_tokens: Optional[int], context: Optional[str]) -> Tuple[Optional[str], Dict[str, Any], Any, str]:
+        """记录用户输入并准备请求参数，返回 (缓存命中的响应, 请求参数, 查询向量, 系统提示词哈希)"""
+        self._apply_summary()
         
         # 添加用户输入
         self.add_message("user", user_input)
         
+        # 查询语义缓存
+        query_embedding = None
+        prompt_hash = self._system_prompt_hash
+        if self.semantic_cache is not None:
+            query_embedding = self.semantic_cache.embed(user_input)
+            cached_response = self.semantic_cache.lookup(query_embedding, prompt_hash)
+            if cached_response is not None:
+                self.add_message("assistant", cached_response)
+                return cached_response, {}, query_embedding, prompt_hash
+        
+        # 动态检索内容作为独立消息放在历史之后，不改动可缓存的前缀
+        messages = self.conversation_history
+        if context:
+            messages = messages[:-1] + [{"role": "user", "content": f"[memory]\n{context}"}] + messages[-1:]
+        
         # 使用环境变量中的默认值
         model = model or self.model
-        temperature = temperature or self.temperature
         max_tokens = max_tokens or self.max_tokens
         
+        # 按上下文窗口剩余空间收紧 max_tokens，避免预留无法使用的输出容量
+        prompt_tokens = _count_tokens(messages, model)
+        # 提示词已超出上下文窗口时保持原值，由服务端返回明确的错误而不是只生成 1 个 token
+        if prompt_tokens is not None and self.context_window - prompt_tokens - 16 > 0:
+            max_tokens = min(max_tokens, self.context_window - prompt_tokens - 16)
+        
+        params = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature or self.temperature,
+            "max_tokens": max_tokens,
+            "stream": True
+        }
+        if self.stop:
+            params["stop"] = self.stop
+        # 投机解码参数仅对自托管的 vLLM/TGI 等引擎有意义，只在显式配置草稿模型时发送
+        if self.draft_model:
+            params["extra_body"] = {
+                "speculative_model": self.draft_model,
+                "num_speculative_tokens": self.num_speculative_tokens
+            }
+        return None, params, query_embedding, prompt_hash
+    
+    def _finish_response(self, parts: List[str], query_embedding: Any, prompt_hash: str):
+        """将完整的助手响应写入对话历史和语义缓存"""
+        assistant_response = "".join(parts)
+        
+        # 添加助手响应到对话历史
+        self.add_message("assistant", assistant_response)
+        
+        if self.semantic_cache is not None:
+            self.semantic_cache.add(query_embedding, prompt_hash, assistant_response)
+    
+    def iter_response(self, user_input: str, model: Optional[str] = None, temperature: Optional[float] = None, max_tokens: Optional[int] = None, context: Optional[str] = None) -> Iterator[str]:
+        """流式生成响应，逐块产出文本；context 为本次查询检索到的记忆/上下文，仅随本次请求发送"""
+        cached_response, params, query_embedding, prompt_hash = self._prepare_request(user_input, model, temperature, max_tokens, context)
+        if cached_response is not None:
+            yield cached_response
+            self._compact_history()
+            return
+        
+        parts: List[str] = []
         try:
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=self.conversation_history,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            
-            assistant_response = response.choices[0].message.content
-            
-            # 添加助手响应到对话历史
-            self.add_message("assistant", assistant_response)
-            
-            return assistant_response
+            stream = self.client.chat.completions.create(**params)
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            yield f"Error generating response: {str(e)}"
+            return
+        
+        self._finish_response(parts, query_embedding, prompt_hash)
+        self._compact_history()
+    
+    async def aiter_response(self, user_input: str, model: Optional[str] = None, temperature: Optional[float] = None, max_tokens: Optional[int] = None, context: Optional[str] = None) -> AsyncIterator[str]:
+        """iter_response 的异步版本，使用 AsyncOpenAI 客户端"""
+        cached_response, params, query_embedding, prompt_hash = self._prepare_request(user_input, model, temperature, max_tokens, context)
+        if cached_response is not None:
+            yield cached_response
+            self._compact_history()
+            return
+        
+        parts: List[str] = []
+        try:
+            stream = await self.async_client.chat.completions.create(**params)
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                if delta:
+                    parts.append(delta)
+                    yield delta
         except Exception as e:
-            return f"Error generating response: {str(e)}"
+            yield f"Error generating response: {str(e)}"
+            return
+        
+        self._finish_response(parts, query_embedding, prompt_hash)
+        self._compact_history()
+    
+    async def agenerate_response(self, user_input: str, model: Optional[str] = None, temperature: Optional[float] = None, max_tokens: Optional[int] = None, context: Optional[str] = None) -> str:
+        """异步生成完整响应"""
+        parts = []
+        async for delta in self.aiter_response(user_input, model=model, temperature=temperature, max_tokens=max_tokens, context=context):
+            parts.append(delta)
+        return "".join(parts)
+    
+    def generate_response(self, user_input: str, model: Optional[str] = None, temperature: Optional[float] = None, max_tokens: Optional[int] = None, context: Optional[str] = None) -> str:
+        """生成完整响应"""
+        return "".join(self.iter_response(user_input, model=model, temperature=temperature, max_tokens=max_tokens, context=context))
     
     def clear_history(self):
         """清除对话历史"""
-        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+        self._dynamic_tail = []
+        self._rolling_summary = ""
+        self._history_generation += 1
+        if self.semantic_cache is not None:
+            self.semantic_cache.save()
     
     def get_history(self) -> List[Dict[str, str]]:
         """获取对话历史"""
@@ -75,25 +450,38 @@ class AgentManager:
     def __init__(self, llm_interface: LLMInterface):
         """初始化智能体管理器"""
         self.llm = llm_interface
-        self.agents = {
-            "default": {
+        # 角色表只读；在实例化时构建，以便读取 load_dotenv 之后的环境变量
+        self.agents: Mapping[str, Mapping[str, Any]] = MappingProxyType({
+            "default": MappingProxyType({
                 "system_prompt": os.getenv("SYSTEM_PROMPT", "你是一个有帮助的助手。使用中文回答。"),
-                "voice": "default"
-            }
-        }
+                "voice": "default",
+                "stop": ("\nUser:",)
+            })
+        })
+        self._agent_names = tuple(self.agents)
+        # 预先计算各角色系统提示词的哈希，切换角色时无需重新计算
+        self._prompt_hashes = {name: _hash_prompt(agent["system_prompt"]) for name, agent in self.agents.items()}
+        # LLMInterface 初始即使用默认角色的系统提示词，这里同步其停止序列
+        self._apply_stop(self.agents["default"])
     
     def set_agent(self, agent_name: str):
         """设置智能体角色"""
-        if agent_name in self.agents:
-            agent = self.agents[agent_name]
-            self.llm.set_system_prompt(agent["system_prompt"])
+        agent = self.agents.get(agent_name)
+        if agent is not None:
+            self.llm.set_system_prompt(agent["system_prompt"], self._prompt_hashes[agent_name])
+            self._apply_stop(agent)
             return True
         return False
     
+    def _apply_stop(self, agent: Mapping[str, Any]):
+        """将角色的停止序列设置到 LLM 接口"""
+        stop = agent.get("stop")
+        self.llm.stop = list(stop) if stop else None
+    
     def list_agents(self) -> List[str]:
         """列出可用的智能体角色"""
-        return list(self.agents.keys())
+        return list(self._agent_names)
     
-    def get_agent_info(self, agent_name: str) -> Optional[Dict[str, str]]:
+    def get_agent_info(self, agent_name: str) -> Optional[Mapping[str, Any]]:
         """获取智能体角色信息"""
         return self.agents.get(agent_name)
@@ -9,20 +9,30 @@ ANT 项目安装脚本
 import os
 import sys
 import subprocess
+import shutil
 import platform
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 
-def run_command(cmd, shell=True, check=False):
-    """运行命令并返回结果"""
+def run_command(cmd, shell=True, check=False, env=None, output="capture"):
+    """运行命令并返回结果
+
+    output: "capture" 捕获输出，"stream" 直接输出到终端，"discard" 丢弃输出
+    """
+    if output == "capture":
+        streams = {"capture_output": True, "text": True}
+    elif output == "discard":
+        streams = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+    else:
+        streams = {}
     try:
-        result = subprocess.run(
-            cmd, shell=shell, capture_output=True, text=True, check=check
-        )
+        result = subprocess.run(cmd, shell=shell, check=check, env=env, **streams)
         return result
     except subprocess.CalledProcessError as e:
         print(f"命令执行失败: {cmd}")
-        print(f"错误输出: {e.stderr}")
+        if e.stderr:
+            print(f"错误输出: {e.stderr}")
         return e
 
 
@@ -35,19 +45,35 @@ def check_python_version():
     return version
 
 
-def install_package(package, python_path=None, extra_index_url=None):
-    """安装单个包，支持优雅降级"""
+def pip_install_command(python):
+    """构造安装命令，优先使用 uv（解析速度远快于 pip）"""
+    uv = shutil.which("uv")
+    if uv:
+        return [uv, "pip", "install", "--python", python, "-U"]
+    return [python, "-m", "pip", "install", "-U", "--upgrade-strategy", "only-if-needed"]
+
+
+def install_packages(packages, python_path=None, extra_index_url=None):
+    """在一次调用中安装多个包，依赖解析只运行一次"""
     python = python_path or sys.executable
-    cmd = [python, "-m", "pip", "install", "-U"]
+    cmd = pip_install_command(python)
     if extra_index_url:
         cmd.extend(["--extra-index-url", extra_index_url])
-    cmd.append(package)
+    for package in packages:
+        # 允许包名后附带安装参数，如 "flash-attn --no-build-isolation"
+        cmd.extend(package.split())
     
-    print(f"安装: {package}")
-    result = run_command(cmd, shell=False)
+    env = dict(os.environ, PIP_DISABLE_PIP_VERSION_CHECK="1")
+    print(f"安装: {' '.join(packages)}")
+    result = run_command(cmd, shell=False, env=env, output="stream")
     return result.returncode == 0 if hasattr(result, 'returncode') else False
 
 
+def install_package(package, python_path=None, extra_index_url=None):
+    """安装单个包，支持优雅降级"""
+    return install_packages([package], python_path, extra_index_url)
+
+
 def install_optional_package(package, python_path=None, fallback=None):
     """安装可选包，失败时尝试降级"""
     print(f"尝试安装可选包: {package}")
@@ -141,41 +167,43 @@ def main():
     print("\n1. 升级 pip")
     install_package("pip", venv_python)
 
-    # 安装必要依赖
-    print("\n2. 安装必要依赖")
-    base_packages = ["numpy", "torch", "transformers"]
-    for pkg in base_packages:
-        install_package(pkg, venv_python)
-
-    # 安装 ASR 相关依赖
+    # 收集所有必要依赖，合并为一次安装
+    required = ["numpy", "torch", "transformers"]
+    optional = []
     if not args.only_tts and not args.only_nlp:
-        print("\n3. 安装 ASR 相关依赖")
-        install_package("qwen-asr", venv_python)
+        required.append("qwen-asr")
         if not args.no_optional:
-            install_package("qwen-asr[vllm]", venv_python)
-            install_optional_package("flash-attn --no-build-isolation", venv_python)
-
-    # 安装 TTS 相关依赖
+            optional.append("qwen-asr[vllm]")
+            optional.append("flash-attn --no-build-isolation")
     if not args.only_asr and not args.only_nlp:
-        print("\n4. 安装 TTS 相关依赖")
-        install_package("qwen-tts", venv_python)
+        required.append("qwen-tts")
         if not args.no_optional:
-            install_optional_package("flash-attn --no-build-isolation", venv_python)
-
-    # 安装 NLP 相关依赖
+            optional.append("flash-attn --no-build-isolation")
     if not args.only_asr and not args.only_tts:
-        print("\n5. 安装 NLP 相关依赖")
-        install_package("openai", venv_python)
-        install_package("transformers", venv_python)
-        install_package("python-dotenv", venv_python)
+        required.extend(["openai", "transformers", "python-dotenv"])
+    required.extend(["python-dotenv", "soundfile"])
+    required = list(dict.fromkeys(required))
+    optional = list(dict.fromkeys(optional))
+
+    # 安装必要依赖
+    print("\n2. 安装必要依赖")
+    if not install_packages(required, venv_python):
+        # 批量安装失败时逐个安装，避免单个包拖累全部
+        print("批量安装失败，改为逐个安装")
+        for pkg in required:
+            if install_package(pkg, venv_python):
+                print(f"✓ {pkg} 安装成功")
+            else:
+                print(f"✗ {pkg} 安装失败")
 
-    # 安装其他必要依赖
-    print("\n6. 安装其他必要依赖")
-    install_package("python-dotenv", venv_python)
-    install_package("soundfile", venv_python)
+    # 安装可选依赖，失败不影响其他包
+    if optional:
+        print("\n3. 安装可选依赖")
+        for pkg in optional:
+            install_optional_package(pkg, venv_python)
 
     # 验证安装
-    print("\n6. 验证安装结果")
+    print("\n4. 验证安装结果")
     packages_to_check = []
     if not args.only_tts and not args.only_nlp:
         packages_to_check.append("qwen-asr")
@@ -184,8 +212,14 @@ def main():
     if not args.only_asr and not args.only_tts:
         packages_to_check.extend(["openai", "transformers"])
 
-    for pkg in packages_to_check:
-        result = run_command([venv_python, "-m", "pip", "show", pkg], shell=False)
+    # 并发检查，只关心返回码
+    def check_installed(pkg):
+        return run_command([venv_python, "-m", "pip", "show", pkg], shell=False, output="discard")
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(check_installed, packages_to_check))
+
+    for pkg, result in zip(packages_to_check, results):
         if result.returncode == 0:
             print(f"✓ {pkg} 已安装")
         else: